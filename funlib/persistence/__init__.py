@@ -1,4 +1,12 @@
-from .arrays import Array, open_ds, prepare_ds  # noqa
+from .arrays import (  # noqa
+    Array,
+    ArraySpec,
+    LazyArray,
+    open_ds,
+    open_ds_spec,
+    open_datasets,
+    prepare_ds,
+)
 
 __version__ = "0.2.0"
 __version_info__ = tuple(int(i) for i in __version__.split("."))
@@ -1,2 +1,9 @@
 from .array import Array  # noqa
-from .datasets import prepare_ds, open_ds  # noqa
+from .datasets import (  # noqa
+    ArraySpec,
+    LazyArray,
+    prepare_ds,
+    open_ds,
+    open_ds_spec,
+    open_datasets,
+)
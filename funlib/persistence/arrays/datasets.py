@@ -1,73 +1,90 @@
 from .array import Array
+from .stores import MemoryMappedDirectoryStore
 
 from funlib.geometry import Coordinate, Roi
 
 import zarr
+from zarr.storage import ConsolidatedMetadataStore
+from zarr.util import json_dumps, json_loads as zarr_json_loads
 import h5py
+import numpy as np
 
-import json
 import logging
 import os
 import shutil
-from typing import Optional, Union
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from math import isqrt
+from typing import List, Literal, NamedTuple, Optional, Union, overload
 
 logger = logging.getLogger(__name__)
 
+_VOXEL_SIZE_OFFSET_ATTRS = {
+    "resolution",
+    "scale",
+    "pixelResolution",
+    "transform",
+    "offset",
+}
+
 
 def _read_voxel_size_offset(ds, order="C"):
     voxel_size = None
     offset = None
-    dims = None
-
-    if "resolution" in ds.attrs:
-        voxel_size = Coordinate(ds.attrs["resolution"])
-        dims = len(voxel_size)
-    elif "scale" in ds.attrs:
-        voxel_size = Coordinate(ds.attrs["scale"])
-        dims = len(voxel_size)
-    elif "pixelResolution" in ds.attrs:
-        voxel_size = Coordinate(ds.attrs["pixelResolution"]["dimensions"])
-        dims = len(voxel_size)
-
-    elif "transform" in ds.attrs:
+
+    # read all attributes at once, each access to ds.attrs might hit the backend
+    if isinstance(ds, h5py.Dataset):
+        attrs = {k: ds.attrs[k] for k in ds.attrs.keys() & _VOXEL_SIZE_OFFSET_ATTRS}
+    else:
+        attrs = dict(ds.attrs)
+
+    transform = attrs.get("transform")
+    if transform is not None:
         # Davis saves transforms in C order regardless of underlying
         # memory format (i.e. n5 or zarr). May be explicitly provided
         # as transform.ordering
-        transform_order = ds.attrs["transform"].get("ordering", "C")
-        voxel_size = Coordinate(ds.attrs["transform"]["scale"])
-        if transform_order != order:
-            voxel_size = Coordinate(voxel_size[::-1])
-        dims = len(voxel_size)
-
-    if "offset" in ds.attrs:
-        offset = Coordinate(ds.attrs["offset"])
-        if dims is not None:
-            assert dims == len(
+        reverse_transform = transform.get("ordering", "C") != order
+
+    if "resolution" in attrs:
+        voxel_size = attrs["resolution"]
+    elif "scale" in attrs:
+        voxel_size = attrs["scale"]
+    elif "pixelResolution" in attrs:
+        voxel_size = attrs["pixelResolution"]["dimensions"]
+    elif transform is not None:
+        voxel_size = transform["scale"]
+        if reverse_transform:
+            voxel_size = voxel_size[::-1]
+
+    if "offset" in attrs:
+        offset = attrs["offset"]
+        if voxel_size is not None:
+            assert len(voxel_size) == len(
                 offset
             ), "resolution and offset attributes differ in length"
-        else:
-            dims = len(offset)
-
-    elif "transform" in ds.attrs:
-        transform_order = ds.attrs["transform"].get("ordering", "C")
-        offset = Coordinate(ds.attrs["transform"]["translate"])
-        if transform_order != order:
-            offset = Coordinate(offset[::-1])
-
-    if dims is None:
-        dims = len(ds.shape)
+    elif transform is not None:
+        offset = transform["translate"]
+        if reverse_transform:
+            offset = offset[::-1]
 
     if voxel_size is None:
-        voxel_size = Coordinate((1,) * dims)
+        dims = len(offset) if offset is not None else len(ds.shape)
+        voxel_size = (1,) * dims
 
     if offset is None:
-        offset = Coordinate((0,) * dims)
+        offset = (0,) * len(voxel_size)
 
     if order == "F":
-        offset = Coordinate(offset[::-1])
-        voxel_size = Coordinate(voxel_size[::-1])
+        offset = offset[::-1]
+        voxel_size = voxel_size[::-1]
+
+    voxel_size = Coordinate(voxel_size)
+    offset = Coordinate(offset)
 
-    if voxel_size is not None and (offset / voxel_size) * voxel_size != offset:
+    if any(o % v != 0 for o, v in zip(offset, voxel_size)):
         # offset is not a multiple of voxel_size. This is often due to someone defining
         # offset to the point source of each array element i.e. the center of the rendered
         # voxel, vs the offset to the corner of the voxel.
@@ -76,19 +93,164 @@ def _read_voxel_size_offset(ds, order="C"):
         logger.debug(
             f"Offset: {offset} being rounded to nearest voxel size: {voxel_size}"
         )
-        offset = (
-            (Coordinate(offset) + (Coordinate(voxel_size) / 2)) / Coordinate(voxel_size)
-        ) * Coordinate(voxel_size)
+        offset = Coordinate(
+            int((o + v // 2) / v) * v for o, v in zip(offset, voxel_size)
+        )
         logger.debug(f"Rounded offset: {offset}")
 
-    return Coordinate(voxel_size), Coordinate(offset)
+    return voxel_size, offset
+
+
+def _is_remote(filename):
+    """Check whether a container is accessed through a protocol like ``s3://``
+    instead of the local filesystem."""
+    return "://" in filename
+
+
+def _open_zarr_root(filename, mode, mmap=False):
+    """Open the root group of a zarr container. When reading from a remote
+    store, consolidated metadata (``.zmetadata``, see
+    ``zarr.consolidate_metadata``) is used if present, such that all metadata
+    is fetched with a single request instead of one per group and array.
+
+    Local stores are always read directly, since consolidated metadata does
+    not reflect changes made to the container after consolidation. If
+    ``mmap`` is set, files of local directory stores are memory-mapped."""
+
+    if mmap and os.path.isdir(filename):
+        return zarr.open(MemoryMappedDirectoryStore(filename), mode=mode)
 
+    if mode == "r" and _is_remote(filename):
+        try:
+            return zarr.open_consolidated(filename, mode=mode)
+        except KeyError:
+            logger.debug("no consolidated metadata in %s", filename)
+
+    return zarr.open(filename, mode=mode)
+
+
+def _get_zarr_dataset(root, filename, ds_name, mode):
+    """Get a dataset from a root group opened with :func:`_open_zarr_root`."""
+
+    try:
+        return root[ds_name]
+    except KeyError:
+        if not isinstance(root.store, ConsolidatedMetadataStore):
+            raise
+        # consolidated metadata does not (yet) list ds_name
+        logger.debug("%s not in consolidated metadata of %s", ds_name, filename)
+        return zarr.open(filename, mode=mode)[ds_name]
+
+
+def _zarr_to_array(ds, order) -> Array:
+    """Create an :class:`Array` for a zarr or N5 dataset."""
+
+    voxel_size, offset = _read_voxel_size_offset(ds, order)
+    shape = Coordinate(ds.shape[-len(voxel_size) :])
+    roi = Roi(offset, voxel_size * shape)
 
-def open_ds(filename: str, ds_name: str, mode: str = "r") -> Array:
+    return Array(ds, roi, voxel_size, chunk_shape=ds.chunks)
+
+
+class _OpenOptions(NamedTuple):
+    """Backend specific options of :func:`open_ds`."""
+
+    mmap: bool = False
+    rdcc_nbytes: Optional[int] = None
+    rdcc_nslots: Optional[int] = None
+
+
+class LazyArray:
+    """A proxy for the :class:`Array` returned by :func:`open_ds` with
+    ``lazy=True``, which is only opened on first attribute access or
+    indexing."""
+
+    def __init__(self, filename: str, ds_name: str, mode: str, options: _OpenOptions):
+        self._filename = filename
+        self._ds_name = ds_name
+        self._mode = mode
+        self._options = options
+        self._array: Optional[Array] = None
+
+    def _open(self) -> Array:
+        if self._array is None:
+            self._array = _open_ds(
+                self._filename, self._ds_name, self._mode, self._options
+            )
+        return self._array
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the proxy itself, private
+        # ones are missing only before __init__ (e.g., during unpickling)
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._open(), name)
+
+    def __getitem__(self, key):
+        return self._open()[key]
+
+    def __setitem__(self, roi, value):
+        self._open()[roi] = value
+
+
+@overload
+def open_ds(
+    filename: str,
+    ds_name: str,
+    mode: str = ...,
+    lazy: Literal[False] = ...,
+    mmap: bool = ...,
+    rdcc_nbytes: Optional[int] = ...,
+    rdcc_nslots: Optional[int] = ...,
+) -> Array: ...
+
+
+@overload
+def open_ds(
+    filename: str,
+    ds_name: str,
+    mode: str = ...,
+    *,
+    lazy: Literal[True],
+    mmap: bool = ...,
+    rdcc_nbytes: Optional[int] = ...,
+    rdcc_nslots: Optional[int] = ...,
+) -> LazyArray: ...
+
+
+@overload
+def open_ds(
+    filename: str,
+    ds_name: str,
+    mode: str = ...,
+    lazy: bool = ...,
+    mmap: bool = ...,
+    rdcc_nbytes: Optional[int] = ...,
+    rdcc_nslots: Optional[int] = ...,
+) -> Union[Array, LazyArray]: ...
+
+
+def open_ds(
+    filename: str,
+    ds_name: str,
+    mode: str = "r",
+    lazy: bool = False,
+    mmap: bool = False,
+    rdcc_nbytes: Optional[int] = None,
+    rdcc_nslots: Optional[int] = None,
+) -> Union[Array, LazyArray]:
     """Open a Zarr, N5, or HDF5 dataset as an :class:`Array`. If the
     dataset has attributes ``resolution`` and ``offset``, those will be
     used to determine the meta-information of the returned array.
 
+    When reading from a remote Zarr container, consolidated metadata will be
+    used if available. Consider calling ``zarr.consolidate_metadata(filename)``
+    once the container has been written.
+
+    Datasets opened in mode ``r`` from local Zarr or N5 containers are
+    cached, such that opening the same dataset again does not read its
+    metadata again, unless the dataset was modified in the meantime.
+
     Args:
 
         filename:
@@ -100,76 +262,281 @@ def open_ds(filename: str, ds_name: str, mode: str = "r") -> Array:
 
             The name of the dataset to open.
 
+        mode:
+
+            The mode to open the container in.
+
+        lazy:
+
+            If set, do not access the dataset until the returned array is
+            used, and return a :class:`LazyArray` instead. Attribute access
+            and indexing are forwarded to the :class:`Array` opened at that
+            time.
+
+        mmap:
+
+            If set, memory-map the chunk files of local Zarr containers
+            instead of reading them. This speeds up random access to
+            uncompressed datasets, but has no benefit for compressed ones.
+
+        rdcc_nbytes:
+
+            The size of the chunk cache of HDF5 datasets in bytes. If
+            ``None``, the default of ``h5py`` is used (1 MiB). Larger caches
+            avoid re-reading chunks for many small reads, at the cost of
+            memory for each opened file.
+
+        rdcc_nslots:
+
+            The number of slots in the chunk cache of HDF5 datasets. If
+            ``None``, the default of ``h5py`` is used.
+
     Returns:
 
         A :class:`Array` pointing to the dataset.
     """
 
-    if filename.endswith(".zarr") or filename.endswith(".zip"):
+    options = _OpenOptions(mmap, rdcc_nbytes, rdcc_nslots)
+
+    if lazy:
+        return LazyArray(filename, ds_name, mode, options)
+
+    return _open_ds(filename, ds_name, mode, options)
+
+
+def open_datasets(
+    filename: str, ds_names: List[str], mode: str = "r", max_workers: int = 32
+) -> List[Array]:
+    """Open several datasets of the same container concurrently. This is
+    useful for remote containers, where opening a dataset is dominated by
+    the latency of fetching its metadata.
+
+    Args:
+
+        filename:
+
+            The name of the container "file".
+
+        ds_names:
+
+            The names of the datasets to open.
+
+        mode:
+
+            The mode to open the container in.
+
+        max_workers:
+
+            The maximal number of datasets to open at the same time.
+
+    Returns:
+
+        A list of :class:`Array`, in the same order as ``ds_names``.
+    """
+
+    extension = _get_extension(filename)
+
+    if extension in (".zarr", ".zip", ".n5"):
         assert (
-            not filename.endswith(".zip") or mode == "r"
+            extension != ".zip" or mode == "r"
         ), "Only reading supported for zarr ZipStore"
 
-        logger.debug("opening zarr dataset %s in %s", ds_name, filename)
-        try:
-            ds = zarr.open(filename, mode=mode)[ds_name]
-        except Exception as e:
-            logger.error("failed to open %s/%s" % (filename, ds_name))
-            raise e
+        # open the container (and fetch consolidated metadata) only once
+        if extension == ".n5":
+            root = zarr.open(filename, mode=mode)
+        else:
+            root = _open_zarr_root(filename, mode)
+
+        def open_dataset(ds_name):
+            ds = _get_zarr_dataset(root, filename, ds_name, mode)
+            return _zarr_to_array(ds, "F" if extension == ".n5" else ds.order)
 
-        voxel_size, offset = _read_voxel_size_offset(ds, ds.order)
-        shape = Coordinate(ds.shape[-len(voxel_size) :])
-        roi = Roi(offset, voxel_size * shape)
+    else:
 
-        chunk_shape = ds.chunks
+        def open_dataset(ds_name):
+            return _open_ds(filename, ds_name, mode)
 
-        logger.debug("opened zarr dataset %s in %s", ds_name, filename)
-        return Array(ds, roi, voxel_size, chunk_shape=chunk_shape)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(open_dataset, ds_names))
 
-    elif filename.endswith(".n5"):
-        logger.debug("opening N5 dataset %s in %s", ds_name, filename)
-        ds = zarr.open(filename, mode=mode)[ds_name]
 
-        voxel_size, offset = _read_voxel_size_offset(ds, "F")
-        shape = Coordinate(ds.shape[-len(voxel_size) :])
-        roi = Roi(offset, voxel_size * shape)
+@dataclass(frozen=True)
+class ArraySpec:
+    """The location and meta-information of a dataset, as returned by
+    :func:`open_ds_spec`. Unlike an :class:`Array`, this does not hold a
+    handle to the underlying data and is therefore cheap to pickle, e.g.,
+    to send to worker processes. Use :meth:`open` to get the
+    :class:`Array`."""
 
-        chunk_shape = ds.chunks
+    filename: str
+    ds_name: str
+    mode: str
+    roi: Roi
+    voxel_size: Coordinate
+    chunk_shape: Optional[Coordinate]
 
-        logger.debug("opened N5 dataset %s in %s", ds_name, filename)
-        return Array(ds, roi, voxel_size, chunk_shape=chunk_shape)
+    def open(self) -> Array:
+        """Open the dataset described by this spec."""
+        return _open_ds(self.filename, self.ds_name, self.mode)
 
-    elif filename.endswith(".h5") or filename.endswith(".hdf"):
-        logger.debug("opening H5 dataset %s in %s", ds_name, filename)
-        ds = h5py.File(filename, mode=mode)[ds_name]
 
-        voxel_size, offset = _read_voxel_size_offset(ds, "C")
-        shape = Coordinate(ds.shape[-len(voxel_size) :])
-        roi = Roi(offset, voxel_size * shape)
+def open_ds_spec(filename: str, ds_name: str, mode: str = "r") -> ArraySpec:
+    """Get an :class:`ArraySpec` for a dataset. See :func:`open_ds` for the
+    arguments."""
 
-        chunk_shape = ds.chunks
+    array = _open_ds(filename, ds_name, mode)
+    return ArraySpec(
+        filename, ds_name, mode, array.roi, array.voxel_size, array.chunk_shape
+    )
 
-        logger.debug("opened H5 dataset %s in %s", ds_name, filename)
-        return Array(ds, roi, voxel_size, chunk_shape=chunk_shape)
 
-    elif filename.endswith(".json"):
-        logger.debug("found JSON container spec")
-        with open(filename, "r") as f:
-            spec = json.load(f)
+def _open_ds(
+    filename: str, ds_name: str, mode: str, options: _OpenOptions = _OpenOptions()
+) -> Array:
+    mtime = _get_mtime(filename, ds_name) if mode == "r" else None
+    if mtime is None:
+        return _open_ds_impl(filename, ds_name, mode, options)
+
+    array = _open_ds_cached(os.path.abspath(filename), ds_name, mode, options, mtime)
+
+    # hand out a new view, such that changes to the returned array (e.g., via
+    # materialize()) do not affect the cached one
+    return Array(
+        array.data,
+        array.roi,
+        array.voxel_size,
+        array.data_roi.begin,
+        chunk_shape=array.chunk_shape,
+    )
+
+
+def _get_mtime(filename: str, ds_name: str) -> Optional[int]:
+    """Get the modification time of a dataset stored as a local directory
+    (i.e., in a Zarr or N5 container), or ``None`` for all other datasets.
+
+    Only the former are cached: they do not keep files open (unlike HDF5 or
+    zip containers), and a change to their metadata is reflected in the
+    modification time of their directory (unlike for JSON specs, which point
+    to another container)."""
+
+    ds_path = os.path.join(filename, ds_name.lstrip("/"))
+    if os.path.isdir(ds_path):
+        # zarr and N5 replace the dataset's metadata files on change, which
+        # updates the modification time of the dataset directory
+        return os.stat(ds_path).st_mtime_ns
+    return None
+
+
+@lru_cache(maxsize=128)
+def _open_ds_cached(
+    filename: str, ds_name: str, mode: str, options: _OpenOptions, mtime: int
+) -> Array:
+    # mtime is only part of the cache key, to not return stale datasets
+    return _open_ds_impl(filename, ds_name, mode, options)
 
-        array = open_ds(spec["container"], ds_name, mode)
-        return Array(
-            array.data,
-            Roi(spec["offset"], spec["size"]),
-            array.voxel_size,
-            array.roi.begin,
-            chunk_shape=array.chunk_shape,
-        )
 
-    else:
+def _open_ds_impl(
+    filename: str, ds_name: str, mode: str, options: _OpenOptions
+) -> Array:
+    try:
+        opener = _OPENERS[_get_extension(filename)]
+    except KeyError:
         logger.error("don't know data format of %s in %s", ds_name, filename)
         raise RuntimeError("Unknown file format for %s" % filename)
 
+    return opener(filename, ds_name, mode, options)
+
+
+def _open_zarr(filename: str, ds_name: str, mode: str, options: _OpenOptions) -> Array:
+    assert (
+        not filename.endswith(".zip") or mode == "r"
+    ), "Only reading supported for zarr ZipStore"
+
+    logger.debug("opening zarr dataset %s in %s", ds_name, filename)
+    try:
+        root = _open_zarr_root(filename, mode, options.mmap)
+        ds = _get_zarr_dataset(root, filename, ds_name, mode)
+    except Exception as e:
+        logger.error("failed to open %s/%s" % (filename, ds_name))
+        raise e
+
+    array = _zarr_to_array(ds, ds.order)
+
+    logger.debug("opened zarr dataset %s in %s", ds_name, filename)
+    return array
+
+
+def _open_n5(filename: str, ds_name: str, mode: str, options: _OpenOptions) -> Array:
+    logger.debug("opening N5 dataset %s in %s", ds_name, filename)
+    ds = zarr.open(filename, mode=mode)[ds_name]
+
+    array = _zarr_to_array(ds, "F")
+
+    logger.debug("opened N5 dataset %s in %s", ds_name, filename)
+    return array
+
+
+def _open_h5(filename: str, ds_name: str, mode: str, options: _OpenOptions) -> Array:
+    logger.debug("opening H5 dataset %s in %s", ds_name, filename)
+    ds = h5py.File(
+        filename,
+        mode=mode,
+        rdcc_nbytes=options.rdcc_nbytes,
+        rdcc_nslots=options.rdcc_nslots,
+    )[ds_name]
+
+    voxel_size, offset = _read_voxel_size_offset(ds, "C")
+    shape = Coordinate(ds.shape[-len(voxel_size) :])
+    roi = Roi(offset, voxel_size * shape)
+
+    chunk_shape = ds.chunks
+
+    logger.debug("opened H5 dataset %s in %s", ds_name, filename)
+    return Array(ds, roi, voxel_size, chunk_shape=chunk_shape)
+
+
+def _loads_spec(data: bytes):
+    """Parse a JSON container spec, with orjson if it is installed."""
+
+    try:
+        from orjson import loads
+    except ImportError:
+        from json import loads  # type: ignore
+    return loads(data)
+
+
+def _open_json(filename: str, ds_name: str, mode: str, options: _OpenOptions) -> Array:
+    logger.debug("found JSON container spec")
+    with open(filename, "rb") as f:
+        spec = _loads_spec(f.read())
+
+    array = _open_ds(spec["container"], ds_name, mode, options)
+    return Array(
+        array.data,
+        Roi(spec["offset"], spec["size"]),
+        array.voxel_size,
+        array.roi.begin,
+        chunk_shape=array.chunk_shape,
+    )
+
+
+def _get_extension(filename: str) -> str:
+    """Get the extension of a container, including the leading dot. Unlike
+    ``os.path.splitext``, this also returns ``.zarr`` for ``/data/.zarr``."""
+
+    _, dot, extension = filename.rpartition(".")
+    return dot + extension
+
+
+_OPENERS = {
+    ".zarr": _open_zarr,
+    ".zip": _open_zarr,
+    ".n5": _open_n5,
+    ".h5": _open_h5,
+    ".hdf": _open_h5,
+    ".json": _open_json,
+}
+
 
 def prepare_ds(
     filename: str,
@@ -186,6 +553,14 @@ def prepare_ds(
 ) -> Array:
     """Prepare a Zarr or N5 dataset.
 
+    When a new dataset is created in a Zarr container, its metadata is added
+    to the container's consolidated metadata (``.zmetadata``), which is used
+    by :func:`open_ds` for remote containers. Only the entries of the new
+    dataset are updated, unless the container does not have consolidated
+    metadata yet. Concurrent calls to ``prepare_ds`` on the same container
+    might overwrite each other's entries; :func:`open_ds` then falls back to
+    reading the metadata of missing datasets directly.
+
     Args:
 
         filename:
@@ -237,6 +612,7 @@ def prepare_ds(
     """
 
     voxel_size = Coordinate(voxel_size)
+    dtype = np.dtype(dtype)
     if write_size is not None:
         write_size = Coordinate(write_size)
 
@@ -263,12 +639,11 @@ def prepare_ds(
 
     ds_name = ds_name.lstrip("/")
 
-    if filename.endswith(".h5") or filename.endswith(".hdf"):
+    extension = _get_extension(filename)
+    if extension in (".h5", ".hdf"):
         raise RuntimeError("prepare_ds does not support HDF5 files")
-    elif filename.endswith(".zarr"):
-        file_format = "zarr"
-    elif filename.endswith(".n5"):
-        file_format = "n5"
+    elif extension in (".zarr", ".n5"):
+        file_format = extension[1:]
     else:
         raise RuntimeError("Unknown file format for %s" % filename)
 
@@ -289,13 +664,10 @@ def prepare_ds(
             chunk_shape = Coordinate((num_channels,) + chunk_shape)
         voxel_size_with_channels = Coordinate((1,) + voxel_size)
 
-    if not os.path.isdir(filename):
-        logger.debug("Creating new %s", filename)
-        os.makedirs(filename)
-
-        zarr.open(filename, mode="w")
+    # creates the container if it does not exist yet
+    root = zarr.open_group(filename, mode="a")
 
-    if not os.path.isdir(os.path.join(filename, ds_name)):
+    if ds_name not in root:
         logger.debug(
             "Creating new %s in %s with chunk_size %s and write_size %s",
             ds_name,
@@ -307,7 +679,6 @@ def prepare_ds(
         if compressor is not None:
             compressor = zarr.get_codec(compressor)
 
-        root = zarr.open(filename, mode="a")
         ds = root.create_dataset(
             ds_name, shape=shape, chunks=chunk_shape, dtype=dtype, compressor=compressor
         )
@@ -315,6 +686,9 @@ def prepare_ds(
         if file_format == "zarr":
             ds.attrs["resolution"] = voxel_size
             ds.attrs["offset"] = total_roi.begin
+            # keep consolidated metadata up to date for open_ds (N5 stores do
+            # not support consolidated metadata)
+            _update_consolidated_metadata(root.store, ds_name)
         else:
             ds.attrs["resolution"] = voxel_size[::-1]
             ds.attrs["offset"] = total_roi.begin[::-1]
@@ -328,7 +702,10 @@ def prepare_ds(
 
     else:
         logger.debug("Trying to reuse existing dataset %s in %s...", ds_name, filename)
-        ds = open_ds(filename, ds_name, mode="a")
+        ds = root[ds_name]
+        existing_voxel_size, existing_offset = _read_voxel_size_offset(
+            ds, ds.order if file_format == "zarr" else "F"
+        )
 
         compatible = True
 
@@ -336,20 +713,21 @@ def prepare_ds(
             logger.info("Shapes differ: %s vs %s", ds.shape, shape)
             compatible = False
 
-        if ds.roi != total_roi:
-            logger.info("ROIs differ: %s vs %s", ds.roi, total_roi)
+        if existing_offset != total_roi.begin:
+            logger.info("Offsets differ: %s vs %s", existing_offset, total_roi.begin)
             compatible = False
 
-        if ds.voxel_size != voxel_size:
-            logger.info("Voxel sizes differ: %s vs %s", ds.voxel_size, voxel_size)
+        if existing_voxel_size != voxel_size:
+            logger.info("Voxel sizes differ: %s vs %s", existing_voxel_size, voxel_size)
             compatible = False
 
-        if write_size is not None and ds.data.chunks != chunk_shape:
-            logger.info("Chunk shapes differ: %s vs %s", ds.data.chunks, chunk_shape)
+        if write_size is not None and ds.chunks != chunk_shape:
+            logger.info("Chunk shapes differ: %s vs %s", ds.chunks, chunk_shape)
             compatible = False
 
-        if dtype != ds.dtype:
-            logger.info("dtypes differ: %s vs %s", ds.dtype, dtype)
+        ds_dtype = ds.dtype
+        if dtype != ds_dtype:
+            logger.info("dtypes differ: %s vs %s", ds_dtype, dtype)
             compatible = False
 
         if not compatible:
@@ -361,7 +739,8 @@ def prepare_ds(
 
             logger.info("Existing dataset is not compatible, creating new one")
 
-            shutil.rmtree(os.path.join(filename, ds_name))
+            _delete_dataset(root, filename, ds_name)
+            _open_ds_cached.cache_clear()
             return prepare_ds(
                 filename=filename,
                 ds_name=ds_name,
@@ -375,7 +754,102 @@ def prepare_ds(
 
         else:
             logger.info("Reusing existing dataset")
-            return ds
+            return Array(ds, total_roi, voxel_size, chunk_shape=ds.chunks)
+
+
+def _update_consolidated_metadata(store, ds_name):
+    """Add the metadata of a new dataset and its parent groups to the
+    consolidated metadata of a zarr container. If the container does not
+    have consolidated metadata yet, it is created from the metadata of all
+    groups and arrays in the container."""
+
+    try:
+        consolidated = zarr_json_loads(store[".zmetadata"])
+    except KeyError:
+        consolidated = {
+            "zarr_consolidated_format": 1,
+            "metadata": _collect_metadata(store),
+        }
+
+    parts = ds_name.split("/")
+    prefixes = [""] + ["/".join(parts[:i]) + "/" for i in range(1, len(parts) + 1)]
+    for prefix in prefixes:
+        for key in (prefix + ".zgroup", prefix + ".zarray", prefix + ".zattrs"):
+            if key in store:
+                consolidated["metadata"][key] = zarr_json_loads(store[key])
+
+    # entries of deleted datasets that were consolidated with the container
+    consolidated["metadata"] = {
+        key: value
+        for key, value in consolidated["metadata"].items()
+        if not key.startswith(".deleted-")
+    }
+
+    store[".zmetadata"] = json_dumps(consolidated)
+
+
+def _collect_metadata(store, prefix=""):
+    """Collect the metadata of the group at ``prefix`` and of all groups and
+    arrays below it. Unlike ``zarr.consolidate_metadata``, this only lists
+    the content of groups, not of arrays, and thus does not visit chunks."""
+
+    metadata = {}
+    for key in (prefix + ".zgroup", prefix + ".zarray", prefix + ".zattrs"):
+        if key in store:
+            metadata[key] = zarr_json_loads(store[key])
+
+    if prefix + ".zgroup" in store:
+        for name in zarr.storage.listdir(store, prefix.rstrip("/")):
+            # skips metadata files and hidden directories (e.g., datasets
+            # that are being deleted)
+            if name.startswith("."):
+                continue
+            metadata.update(_collect_metadata(store, prefix + name + "/"))
+
+    return metadata
+
+
+def _delete_dataset(root, filename, ds_name):
+    """Delete a dataset from a container. Local datasets are moved to a
+    hidden directory in the container first and then deleted in the
+    background, such that a new dataset can be created in their place
+    without waiting for all chunks to be removed. Hidden directories left
+    over from earlier deletions that did not finish are deleted as well."""
+
+    ds_path = os.path.join(filename, ds_name)
+    if not os.path.isdir(ds_path):
+        del root[ds_name]
+        return
+
+    # the trash directory is on the same filesystem, and since it is not a
+    # group or array it is not visible as part of the container
+    trash_path = None
+    try:
+        trash_path = tempfile.mkdtemp(prefix=".deleted-", dir=filename)
+        os.rename(ds_path, os.path.join(trash_path, "dataset"))
+    except OSError:
+        if trash_path is not None:
+            os.rmdir(trash_path)
+        shutil.rmtree(ds_path)
+
+    trash_paths = [
+        os.path.join(filename, name)
+        for name in os.listdir(filename)
+        if name.startswith(".deleted-")
+    ]
+    if trash_paths:
+        threading.Thread(target=_rmtree, args=(trash_paths,)).start()
+
+
+def _rmtree(paths):
+    for path in paths:
+        try:
+            shutil.rmtree(path)
+        except FileNotFoundError:
+            # deleted concurrently by another process
+            pass
+        except OSError as e:
+            logger.warning("Failed to delete %s: %s", path, e)
 
 
 def get_chunk_shape(block_shape):
@@ -388,15 +862,36 @@ def get_chunk_shape(block_shape):
     return chunk_shape
 
 
+@lru_cache(maxsize=None)
 def get_chunk_size_dim(b, target_chunk_size):
-    best_k = None
+    """Find the divisor of ``b`` closest to ``target_chunk_size``. Ties are
+    resolved in favour of the larger divisor."""
+
+    # divisors come in pairs (i, b // i), so it suffices to search up to sqrt(b)
+    max_i = isqrt(b)
+
+    if max_i > 256:
+        # for many candidates, testing them with numpy is faster
+        i = np.arange(1, max_i + 1, dtype=np.int64)
+        i = i[b % i == 0]
+        divisors = np.concatenate((i, b // i))
+        diffs = np.abs(divisors - target_chunk_size)
+        return int(divisors[diffs == diffs.min()].max())
+
+    best_d = None
     best_target_diff = 0
 
-    for k in range(1, b + 1):
-        if ((b // k) * k) % b == 0:
-            diff = abs(b // k - target_chunk_size)
-            if best_k is None or diff < best_target_diff:
+    for i in range(1, max_i + 1):
+        if b % i != 0:
+            continue
+        for d in (i, b // i):
+            diff = abs(d - target_chunk_size)
+            if (
+                best_d is None
+                or diff < best_target_diff
+                or (diff == best_target_diff and d > best_d)
+            ):
                 best_target_diff = diff
-                best_k = k
+                best_d = d
 
-    return b // best_k
+    return best_d
@@ -0,0 +1,18 @@
+import zarr
+
+import mmap
+import os
+
+
+class MemoryMappedDirectoryStore(zarr.DirectoryStore):
+    """A zarr ``DirectoryStore`` that memory-maps files instead of reading
+    them. For uncompressed arrays, this avoids copying each chunk into memory
+    before it is accessed, which speeds up random access to small regions of
+    large chunks."""
+
+    def _fromfile(self, fn):
+        with open(fn, "rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                # empty files can not be memory-mapped
+                return b""
+            return memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
@@ -0,0 +1,430 @@
+from funlib.persistence.arrays import open_datasets, open_ds, open_ds_spec, prepare_ds
+from funlib.persistence.arrays.datasets import get_chunk_size_dim
+from funlib.persistence.arrays.stores import MemoryMappedDirectoryStore
+from funlib.geometry import Coordinate, Roi
+
+import copy
+import h5py
+import json
+import numpy as np
+import os
+import pickle
+import pytest
+import sys
+import tempfile
+import threading
+import zarr
+
+
+def test_get_chunk_size_dim():
+    def brute_force(b, target_chunk_size):
+        best_k = None
+        best_target_diff = 0
+        for k in range(1, b + 1):
+            if ((b // k) * k) % b == 0:
+                diff = abs(b // k - target_chunk_size)
+                if best_k is None or diff < best_target_diff:
+                    best_target_diff = diff
+                    best_k = k
+        return b // best_k
+
+    for b in list(range(1, 1100)) + [4096, 10000, 65536, 65537, 99991, 262144]:
+        for target in (1, 64, 256):
+            assert get_chunk_size_dim(b, target) == brute_force(b, target)
+
+
+def test_prepare_open_zarr(tmpdir):
+    filename = str(tmpdir / "test.zarr")
+    roi = Roi((10, 20, 30), (100, 200, 300))
+    voxel_size = Coordinate(1, 2, 3)
+
+    array = prepare_ds(filename, "raw", roi, voxel_size, np.float32)
+    array[roi] = 1
+
+    array = open_ds(filename, "raw")
+    assert array.roi == roi
+    assert array.voxel_size == voxel_size
+    assert array.dtype == np.float32
+    assert (array.to_ndarray() == 1).all()
+
+    # reuse of a compatible dataset
+    array = prepare_ds(filename, "raw", roi, voxel_size, np.float32)
+    assert (array.to_ndarray() == 1).all()
+
+
+def test_prepare_open_hidden_zarr(tmpdir):
+    filename = str(tmpdir / ".zarr")
+    roi = Roi((0, 0), (10, 10))
+
+    prepare_ds(filename, "raw", roi, (1, 1), np.uint8)
+    assert open_ds(filename, "raw").roi == roi
+
+
+def test_prepare_open_n5(tmpdir):
+    filename = str(tmpdir / "test.n5")
+    roi = Roi((10, 20, 30), (100, 200, 300))
+    voxel_size = Coordinate(1, 2, 3)
+
+    prepare_ds(filename, "raw", roi, voxel_size, np.uint8)
+
+    array = open_ds(filename, "raw")
+    assert array.roi == roi
+    assert array.voxel_size == voxel_size
+    assert zarr.open(filename)["raw"].attrs["resolution"] == [3, 2, 1]
+
+
+def test_open_h5(tmpdir):
+    filename = str(tmpdir / "test.h5")
+    with h5py.File(filename, "w") as f:
+        ds = f.create_dataset("raw", data=np.zeros((10, 20), dtype=np.uint8))
+        ds.attrs["resolution"] = (4, 2)
+        ds.attrs["offset"] = (8, 4)
+        ds.attrs["unrelated"] = "ignored"
+
+    array = open_ds(filename, "raw")
+    assert array.roi == Roi((8, 4), (40, 40))
+    assert array.voxel_size == Coordinate(4, 2)
+
+    del array
+
+    array = open_ds(filename, "raw", rdcc_nbytes=2**24, rdcc_nslots=1009)
+    _, rdcc_nslots, rdcc_nbytes, _ = array.data.file.id.get_access_plist().get_cache()
+    assert (rdcc_nslots, rdcc_nbytes) == (1009, 2**24)
+
+
+def test_open_consolidated_remote_zarr(tmpdir):
+    pytest.importorskip("fsspec")
+
+    filename = f"memory://{tmpdir.basename}/test.zarr"
+    root = zarr.open_group(filename, mode="w")
+    root.create_dataset("a/raw", shape=(10, 10)).attrs["resolution"] = (1, 1)
+    zarr.consolidate_metadata(filename)
+
+    root.create_dataset("b/raw", shape=(10, 10)).attrs["resolution"] = (2, 2)
+    root["a/raw"].attrs["resolution"] = (3, 3)
+
+    # metadata of a/raw is taken from .zmetadata, i.e., is outdated
+    assert open_ds(filename, "a/raw").voxel_size == Coordinate(1, 1)
+    # b/raw is not listed in .zmetadata, falls back to reading it directly
+    assert open_ds(filename, "b/raw").voxel_size == Coordinate(2, 2)
+
+    # falls back to reading directly without .zmetadata
+    filename = f"memory://{tmpdir.basename}/plain.zarr"
+    root = zarr.open_group(filename, mode="w")
+    root.create_dataset("raw", shape=(10, 10)).attrs["resolution"] = (4, 4)
+    assert open_ds(filename, "raw").voxel_size == Coordinate(4, 4)
+
+
+def test_prepare_consolidates_zarr(tmpdir, monkeypatch):
+    filename = str(tmpdir / "test.zarr")
+    roi = Roi((0, 0), (10, 10))
+
+    # the container's metadata is collected without listing chunks
+    def fail(store):
+        raise AssertionError("consolidated all metadata")
+
+    monkeypatch.setattr(zarr, "consolidate_metadata", fail)
+    prepare_ds(filename, "a/raw", roi, (1, 1), np.uint8)
+    prepare_ds(filename, "b/raw", roi, (2, 2), np.uint8)
+    prepare_ds(filename, "b/c/raw", roi, (1, 2), np.uint8)
+
+    root = zarr.open_consolidated(filename, mode="r")
+    assert "a/raw" in root
+    assert root["b/raw"].attrs["resolution"] == [2, 2]
+    assert root["b/c/raw"].attrs["resolution"] == [1, 2]
+
+
+def test_prepare_consolidates_existing_zarr(tmpdir):
+    filename = str(tmpdir / "test.zarr")
+
+    # a container written without consolidated metadata
+    root = zarr.open_group(filename, mode="w")
+    root.attrs["note"] = "root"
+    root.create_dataset("a/b/raw", shape=(10, 10), chunks=(2, 2))[:] = 1
+    root.create_dataset("c", shape=(10,)).attrs["resolution"] = (2,)
+
+    prepare_ds(filename, "d", Roi((0, 0), (10, 10)), (1, 1), np.uint8)
+
+    store = zarr.DirectoryStore(filename)
+    metadata = json.loads(store[".zmetadata"])["metadata"]
+    assert set(metadata) == {
+        ".zgroup",
+        ".zattrs",
+        "a/.zgroup",
+        "a/b/.zgroup",
+        "a/b/raw/.zarray",
+        "c/.zarray",
+        "c/.zattrs",
+        "d/.zarray",
+        "d/.zattrs",
+    }
+    assert metadata["c/.zattrs"] == {"resolution": [2]}
+
+    # same result as consolidating all keys of the container
+    zarr.consolidate_metadata(store)
+    assert metadata == json.loads(store[".zmetadata"])["metadata"]
+
+
+def test_prepare_incompatible(tmpdir):
+    filename = str(tmpdir / "test.zarr")
+    roi = Roi((0, 0), (10, 10))
+
+    prepare_ds(filename, "raw", roi, (1, 1), np.uint8)
+
+    for kwargs in [
+        {"total_roi": Roi((0, 0), (20, 10)), "voxel_size": (1, 1)},
+        {"total_roi": Roi((1, 0), (10, 10)), "voxel_size": (1, 1)},
+        {"total_roi": roi, "voxel_size": (2, 2)},
+        {"total_roi": roi, "voxel_size": (1, 1), "dtype": np.float32},
+        {"total_roi": roi, "voxel_size": (1, 1), "write_size": (5, 5)},
+    ]:
+        kwargs.setdefault("dtype", np.uint8)
+        with pytest.raises(RuntimeError):
+            prepare_ds(filename, "raw", **kwargs)
+
+    array = prepare_ds(filename, "raw", roi, (1, 1), np.uint8)
+    array[roi] = 1
+
+    array = prepare_ds(filename, "raw", roi, (2, 2), np.uint8, delete=True)
+    assert array.voxel_size == Coordinate(2, 2)
+    assert (array.to_ndarray() == 0).all()
+    assert open_ds(filename, "raw").voxel_size == Coordinate(2, 2)
+
+
+def test_open_lazy(tmpdir):
+    filename = str(tmpdir / "test.zarr")
+    roi = Roi((0, 0), (10, 10))
+
+    # nothing is accessed before use
+    array = open_ds(filename, "raw", mode="a", lazy=True)
+
+    prepare_ds(filename, "raw", roi, (1, 1), np.uint8)
+
+    array[roi] = 3
+    assert array.roi == roi
+    assert array[Coordinate(5, 5)] == 3
+    assert (array.to_ndarray() == 3).all()
+
+    # proxies can be copied and pickled, before and after opening
+    for lazy in (open_ds(filename, "raw", lazy=True), array):
+        assert copy.copy(lazy).roi == roi
+        assert pickle.loads(pickle.dumps(lazy)).roi == roi
+
+
+def test_open_cached(tmpdir):
+    filename = str(tmpdir / "test.zarr")
+    roi = Roi((0, 0), (10, 10))
+
+    prepare_ds(filename, "raw", roi, (1, 1), np.uint8)
+
+    a = open_ds(filename, "raw")
+    b = open_ds(filename, "raw")
+    assert a is not b
+    assert a.data is b.data
+
+    # modifying the dataset's attributes invalidates the cache
+    zarr.open(filename, mode="a")["raw"].attrs["resolution"] = (2, 2)
+    assert open_ds(filename, "raw").voxel_size == Coordinate(2, 2)
+
+
+def test_open_h5_not_cached(tmpdir):
+    filename = str(tmpdir / "test.h5")
+    with h5py.File(filename, "w") as f:
+        f.create_dataset("raw", data=np.zeros((10, 10), dtype=np.uint8))
+
+    array = open_ds(filename, "raw")
+    del array
+
+    # the file is not kept open, and can be opened for writing again
+    with h5py.File(filename, "a") as f:
+        f["raw"].attrs["resolution"] = (2, 2)
+    with h5py.File(filename, "w") as f:
+        f.create_dataset("raw", data=np.zeros((10, 10), dtype=np.uint8))
+
+
+def test_open_json_spec_not_stale(tmpdir):
+    filename = str(tmpdir / "test.zarr")
+    spec_filename = str(tmpdir / "spec.json")
+
+    prepare_ds(filename, "raw", Roi((0, 0), (10, 10)), (1, 1), np.uint8)
+    with open(spec_filename, "w") as f:
+        json.dump({"container": filename, "offset": (0, 0), "size": (10, 10)}, f)
+
+    assert open_ds(spec_filename, "raw").voxel_size == Coordinate(1, 1)
+
+    # changing the dataset, but not the spec, is picked up
+    zarr.open(filename, mode="a")["raw"].attrs["resolution"] = (2, 2)
+    assert open_ds(spec_filename, "raw").voxel_size == Coordinate(2, 2)
+
+
+def test_open_mmap(tmpdir):
+    filename = str(tmpdir / "test.zarr")
+    roi = Roi((0, 0), (10, 10))
+
+    array = prepare_ds(filename, "raw", roi, (1, 1), np.uint16, compressor=None)
+    array[roi] = np.arange(100).reshape(10, 10)
+
+    array = open_ds(filename, "raw", mmap=True)
+    assert isinstance(array.data.store, MemoryMappedDirectoryStore)
+    np.testing.assert_array_equal(
+        array.to_ndarray(Roi((2, 3), (2, 3))), [[23, 24, 25], [33, 34, 35]]
+    )
+
+
+def test_open_json_spec(tmpdir):
+    filename = str(tmpdir / "test.zarr")
+    spec_filename = str(tmpdir / "spec.json")
+
+    prepare_ds(filename, "raw", Roi((0, 0), (10, 10)), (1, 1), np.uint8)
+    with open(spec_filename, "w") as f:
+        json.dump({"container": filename, "offset": (2, 2), "size": (4, 4)}, f)
+
+    array = open_ds(spec_filename, "raw")
+    assert array.roi == Roi((2, 2), (4, 4))
+    assert array.data_roi == Roi((0, 0), (10, 10))
+
+    with pytest.raises(RuntimeError):
+        open_ds(str(tmpdir / "test.tif"), "raw")
+
+
+def test_open_json_spec_without_orjson(tmpdir, monkeypatch):
+    filename = str(tmpdir / "test.zarr")
+    spec_filename = str(tmpdir / "spec.json")
+
+    prepare_ds(filename, "raw", Roi((0, 0), (10, 10)), (1, 1), np.uint8)
+    with open(spec_filename, "w") as f:
+        json.dump({"container": filename, "offset": (2, 2), "size": (4, 4)}, f)
+
+    # importing orjson fails, the spec is parsed with the standard library
+    monkeypatch.setitem(sys.modules, "orjson", None)
+    assert open_ds(spec_filename, "raw").roi == Roi((2, 2), (4, 4))
+
+
+def test_read_voxel_size_offset(tmpdir):
+    filename = str(tmpdir / "test.zarr")
+    root = zarr.open(filename, mode="w")
+
+    ds = root.create_dataset("transform", shape=(10, 10))
+    ds.attrs["transform"] = {"ordering": "F", "scale": [1, 2], "translate": [3, 4]}
+    array = open_ds(filename, "transform")
+    assert array.voxel_size == Coordinate(2, 1)
+    assert array.roi.begin == Coordinate(4, 3)
+
+    # offsets are rounded to the nearest multiple of the voxel size
+    ds = root.create_dataset("unaligned", shape=(10, 10))
+    ds.attrs["resolution"] = [4, 1]
+    ds.attrs["offset"] = [5, 3]
+    array = open_ds(filename, "unaligned")
+    assert array.voxel_size == Coordinate(4, 1)
+    assert array.roi.begin == Coordinate(4, 3)
+
+    # defaults if no attributes are given
+    root.create_dataset("plain", shape=(10, 10))
+    array = open_ds(filename, "plain")
+    assert array.roi == Roi((0, 0), (10, 10))
+
+
+def test_open_datasets(tmpdir):
+    filename = str(tmpdir / "test.zarr")
+    ds_names = [f"raw_{i}" for i in range(1, 10)]
+
+    for i, ds_name in enumerate(ds_names, start=1):
+        prepare_ds(filename, ds_name, Roi((0, 0), (10 * i, 10)), (i, 1), np.uint8)
+
+    arrays = open_datasets(filename, ds_names, max_workers=4)
+    assert [array.voxel_size for array in arrays] == [
+        Coordinate(i, 1) for i in range(1, 10)
+    ]
+
+
+def test_open_ds_spec(tmpdir):
+    filename = str(tmpdir / "test.zarr")
+    roi = Roi((0, 0), (10, 10))
+
+    prepare_ds(filename, "raw", roi, (1, 1), np.uint8, write_size=(5, 5))
+
+    spec = pickle.loads(pickle.dumps(open_ds_spec(filename, "raw")))
+    assert spec.roi == roi
+    assert spec.voxel_size == Coordinate(1, 1)
+    assert spec.chunk_shape == Coordinate(5, 5)
+
+    array = spec.open()
+    assert array.roi == roi
+
+
+def test_open_datasets_remote(tmpdir, monkeypatch):
+    pytest.importorskip("fsspec")
+
+    filename = f"memory://{tmpdir.basename}/test.zarr"
+    root = zarr.open_group(filename, mode="w")
+    for i in range(1, 10):
+        root.create_dataset(f"raw_{i}", shape=(10, 10)).attrs["resolution"] = (i, 1)
+    zarr.consolidate_metadata(filename)
+    root.create_dataset("raw_10", shape=(10, 10)).attrs["resolution"] = (10, 1)
+
+    open_consolidated = zarr.open_consolidated
+    calls = []
+
+    def counting_open_consolidated(*args, **kwargs):
+        calls.append(args)
+        return open_consolidated(*args, **kwargs)
+
+    monkeypatch.setattr(zarr, "open_consolidated", counting_open_consolidated)
+
+    arrays = open_datasets(filename, [f"raw_{i}" for i in range(1, 11)])
+    assert [array.voxel_size for array in arrays] == [
+        Coordinate(i, 1) for i in range(1, 11)
+    ]
+    assert len(calls) == 1
+
+
+def test_prepare_delete(tmpdir, monkeypatch):
+    filename = str(tmpdir / "test.zarr")
+    roi = Roi((0, 0), (10, 10))
+
+    prepare_ds(filename, "raw", roi, (1, 1), np.uint8)[roi] = 1
+    prepare_ds(filename, "raw", roi, (2, 2), np.uint8, delete=True)
+
+    # nothing is left next to the container
+    assert sorted(os.listdir(tmpdir)) == ["test.zarr"]
+    assert "raw" in zarr.open(filename, mode="r")
+
+    # the deleted dataset is not part of the consolidated metadata, even if
+    # the container had none before
+    os.remove(os.path.join(filename, ".zmetadata"))
+    prepare_ds(filename, "raw", roi, (1, 1), np.uint8, delete=True)
+    metadata = json.loads(zarr.DirectoryStore(filename)[".zmetadata"])
+    assert not [key for key in metadata["metadata"] if key.startswith(".deleted-")]
+
+    # leftovers of deletions that did not finish are removed
+    os.makedirs(os.path.join(filename, ".deleted-leftover", "dataset"))
+    prepare_ds(filename, "raw", roi, (2, 2), np.uint8, delete=True)
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join()
+    assert not [name for name in os.listdir(filename) if name.startswith(".deleted-")]
+
+    # deletes in place if the dataset can not be moved
+    def fail(*args, **kwargs):
+        raise OSError()
+
+    monkeypatch.setattr(tempfile, "mkdtemp", fail)
+    array = prepare_ds(filename, "raw", roi, (1, 1), np.uint8, delete=True)
+    assert array.voxel_size == Coordinate(1, 1)
+    assert (array.to_ndarray() == 0).all()
+
+
+def test_prepare_consolidates_nan_attrs(tmpdir):
+    filename = str(tmpdir / "test.zarr")
+    roi = Roi((0, 0), (10, 10))
+
+    prepare_ds(filename, "a", roi, (1, 1), np.float32).data.attrs["min"] = np.nan
+    zarr.open(filename, mode="a").attrs["note"] = np.inf
+    zarr.consolidate_metadata(filename)
+
+    # zarr writes NaN and Infinity as bare literals, which must still parse
+    prepare_ds(filename, "b", roi, (1, 1), np.float32)
+
+    root = zarr.open_consolidated(filename, mode="r")
+    assert np.isnan(root["a"].attrs["min"])
+    assert "b" in root